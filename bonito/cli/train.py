@@ -11,6 +11,7 @@ from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 
 import toml
 import torch
+import torch.distributed as dist
 
 from bonito.training import Trainer
 from bonito.data import load_data, ModelSetup, ComputeSettings, DataSettings
@@ -18,10 +19,21 @@ from bonito.util import __models_dir__, default_config, load_model, load_symbol,
 
 
 def main(args):
+    # launched with torchrun, one process per gpu
+    distributed = "LOCAL_RANK" in os.environ
+    if distributed:
+        local_rank = int(os.environ["LOCAL_RANK"])
+        torch.cuda.set_device(local_rank)
+        dist.init_process_group("nccl")
+        args.device = "cuda:%s" % local_rank
+    is_main = not distributed or dist.get_rank() == 0
+
     workdir = os.path.expanduser(args.training_directory)
     if os.path.exists(workdir) and not args.force:
         print("[error] %s exists, use -f to force continue training." % workdir)
         exit(1)
+    # make sure every process has checked the workdir before it is created
+    if distributed: dist.barrier()
     os.makedirs(workdir, exist_ok=True)
 
     init(args.seed, args.device, (not args.nondeterministic))
@@ -75,7 +87,8 @@ def main(args):
         dataset_cfg = train_loader.dataset.dataset_config
     except AttributeError:
         dataset_cfg = {}
-    toml.dump({**config, **argsdict, **dataset_cfg}, open(os.path.join(workdir, 'config.toml'), 'w'))
+    if is_main:
+        toml.dump({**config, **argsdict, **dataset_cfg}, open(os.path.join(workdir, 'config.toml'), 'w'))
 
     if config.get("lr_scheduler"):
         sched_config = config["lr_scheduler"]
@@ -95,6 +108,9 @@ def main(args):
         quantile_grad_clip=args.quantile_grad_clip,
         chunks_per_epoch=args.chunks,
         batch_size=args.batch,
+        channels_last=args.channels_last,
+        compile=args.compile,
+        use_checkpointing=args.checkpoint_activations,
     )
 
     if (',' in args.lr):
@@ -104,6 +120,9 @@ def main(args):
     optim_kwargs = config.get("optim", {})
     trainer.fit(workdir, args.epochs, lr, **optim_kwargs)
 
+    if distributed:
+        dist.destroy_process_group()
+
 def argparser():
     parser = ArgumentParser(
         formatter_class=ArgumentDefaultsHelpFormatter,
@@ -132,5 +151,8 @@ def argparser():
     quantile_group.add_argument('--no-quantile-grad-clip', dest='quantile_grad_clip', action='store_false')
     quantile_group.set_defaults(quantile_grad_clip=True)
     parser.add_argument("--num-workers", default=4, type=int)
+    parser.add_argument("--channels-last", action="store_true", default=False)
+    parser.add_argument("--compile", action="store_true", default=False)
+    parser.add_argument("--checkpoint-activations", action="store_true", default=False)
     return parser
 
@@ -5,7 +5,9 @@ from pathlib import Path
 from typing import Dict
 
 import numpy as np
-from torch.utils.data import DataLoader
+import torch.distributed as dist
+from torch.utils.data import DataLoader, IterableDataset
+from torch.utils.data.distributed import DistributedSampler
 
 
 @dataclass
@@ -21,6 +23,8 @@ class ComputeSettings:
     num_workers: int
     seed: int
     pin_memory: bool = True
+    persistent_workers: bool = True
+    prefetch_factor: int = 4
 
 @dataclass
 class ModelSetup:
@@ -61,14 +65,44 @@ def load_data(data, model_setup, compute_settings):
         "batch_size": compute_settings.batch_size,
         "num_workers": compute_settings.num_workers,
         "pin_memory": compute_settings.pin_memory,
+        # keep workers alive between epochs rather than respawning them
+        "persistent_workers": compute_settings.persistent_workers,
+        "prefetch_factor": compute_settings.prefetch_factor,
     }
 
+    if dist.is_available() and dist.is_initialized():
+        train_loader_kwargs = distributed_loader_kwargs(train_loader_kwargs, compute_settings.seed)
+        valid_loader_kwargs = distributed_loader_kwargs(valid_loader_kwargs, compute_settings.seed)
+
     # Allow options from the train/valid_loader to override the default_kwargs
-    train_loader = DataLoader(**{**default_settings, **train_loader_kwargs})
-    valid_loader = DataLoader(**{**default_settings, **valid_loader_kwargs})
+    train_loader = DataLoader(**worker_loader_kwargs({**default_settings, **train_loader_kwargs}))
+    valid_loader = DataLoader(**worker_loader_kwargs({**default_settings, **valid_loader_kwargs}))
     return train_loader, valid_loader
 
 
+def worker_loader_kwargs(loader_kwargs):
+    """
+    Drop the worker options that DataLoader rejects when loading in the main process
+    """
+    if loader_kwargs.get("num_workers", 0) > 0:
+        return loader_kwargs
+    return {k: v for k, v in loader_kwargs.items() if k not in ("persistent_workers", "prefetch_factor")}
+
+
+def distributed_loader_kwargs(loader_kwargs, seed=0):
+    """
+    Shard the dataset in `loader_kwargs` across processes with a DistributedSampler
+    """
+    dataset = loader_kwargs["dataset"]
+    if isinstance(dataset, IterableDataset) or {"sampler", "batch_sampler"} & loader_kwargs.keys():
+        # the loader already controls which samples each process sees
+        return loader_kwargs
+    loader_kwargs = dict(loader_kwargs)
+    shuffle = loader_kwargs.pop("shuffle", False)
+    loader_kwargs["sampler"] = DistributedSampler(dataset, shuffle=shuffle, seed=seed)
+    return loader_kwargs
+
+
 class ChunkDataSet:
     def __init__(self, chunks, targets, lengths):
         self.chunks = np.expand_dims(chunks, axis=1)
@@ -2,23 +2,60 @@
 Bonito train
 """
 
-import math
 import os
-import re
-from glob import glob
 from itertools import islice
+from contextlib import nullcontext
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from time import perf_counter
-from collections import OrderedDict
 from datetime import datetime
+from functools import partial
 
+from bonito.nn import RNNWrapper, Stack
 from bonito.schedule import linear_warmup_cosine_decay
-from bonito.util import accuracy, decode_ref, permute, match_names, tqdm_environ, load_object
+from bonito.util import accuracy, decode_refs, permute, match_names, tqdm_environ, load_object
 import bonito
 
 import torch
 import numpy as np
 from tqdm import tqdm
-import torch.cuda.amp as amp
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.checkpoint import checkpoint
+from torch.utils.data.distributed import DistributedSampler
+
+
+def unwrap(model):
+    """
+    Return the underlying model from torch.compile and (Distributed)DataParallel wrappers
+    """
+    model = getattr(model, "_orig_mod", model)
+    return model.module if hasattr(model, "module") else model
+
+
+def to_channels_last(x):
+    """
+    Return `x` with the channel dim innermost in memory (NWC for 1D convs)
+
+    torch.channels_last only covers 4D tensors, so for the 1D case the
+    equivalent strides are produced by a transposed copy.
+    """
+    if x.dim() == 3:
+        return x.transpose(1, 2).contiguous().transpose(1, 2)
+    if x.dim() == 4:
+        return x.contiguous(memory_format=torch.channels_last)
+    return x
+
+
+def checkpoint_activations(model):
+    """
+    Recompute the activations of the rnn and stacked (transformer) layers in the backward pass
+    """
+    blocks = {id(m): m for m in model.modules() if isinstance(m, RNNWrapper)}
+    blocks.update({id(b): b for m in model.modules() if isinstance(m, Stack) for b in m})
+    for block in blocks.values():
+        block.forward = partial(checkpoint, block.forward, use_reentrant=False)
+    return model
 
 
 def load_state(dirname, device, model, optim=None):
@@ -26,16 +63,22 @@ def load_state(dirname, device, model, optim=None):
     Load a model state dict from disk
     """
     model.to(device)
-    if hasattr(model, "module"):
-        model = model.module
+    model = unwrap(model)
 
     weight_no = optim_no = None
 
-    optim_files = glob(os.path.join(dirname, "optim_*.tar"))
-    optim_nos = {int(re.sub(".*_([0-9]+).tar", "\\1", w)) for w in optim_files}
-
-    weight_files = glob(os.path.join(dirname, "weights_*.tar"))
-    weight_nos = {int(re.sub(".*_([0-9]+).tar", "\\1", w)) for w in weight_files}
+    # collect the epoch numbers of weights_{n}.tar and optim_{n}.tar in one pass
+    weight_nos, optim_nos = set(), set()
+    with os.scandir(dirname) as entries:
+        for entry in entries:
+            prefix, _, suffix = entry.name.partition("_")
+            number, _, ext = suffix.partition(".")
+            if ext != "tar" or not number.isdigit():
+                continue
+            if prefix == "weights":
+                weight_nos.add(int(number))
+            elif prefix == "optim":
+                optim_nos.add(int(number))
 
     if optim is not None:
         weight_no = optim_no = max(optim_nos & weight_nos, default=None)
@@ -51,16 +94,15 @@ def load_state(dirname, device, model, optim=None):
     if to_load:
         print("[picking up %s state from epoch %s]" % (', '.join([n for n, _ in to_load]), weight_no))
         for name, obj in to_load:
+            # map the checkpoint lazily rather than reading it all into memory
             state_dict = torch.load(
-                os.path.join(dirname, '%s_%s.tar' % (name, weight_no)), map_location=device
+                os.path.join(dirname, '%s_%s.tar' % (name, weight_no)), map_location=device,
+                mmap=True, weights_only=True
             )
             if name == "weights":
-                state_dict = {k2: state_dict[k1] for k1, k2 in match_names(state_dict, obj).items()}
-                new_state_dict = OrderedDict()
-                for k, v in state_dict.items():
-                    name = k.replace('module.', '')
-                    new_state_dict[name] = v
-                state_dict = new_state_dict
+                state_dict = {
+                    k2.removeprefix('module.'): state_dict[k1] for k1, k2 in match_names(state_dict, obj).items()
+                }
             obj.load_state_dict(state_dict)
         epoch = weight_no
     else:
@@ -70,33 +112,107 @@ def load_state(dirname, device, model, optim=None):
 
 
 class ClipGrad:
-    def __init__(self, quantile=0.5, factor=2.0, buffer_size=100):
-        self.buffer = np.full(buffer_size, fill_value=1e6)
+    def __init__(self, quantile=0.5, factor=2.0, buffer_size=100, foreach=None, device=None):
+        # the buffer and write position stay on device so clipping never syncs with the host
+        self.buffer = torch.full((buffer_size,), 1e6, device=device)
+        self.i = torch.zeros((), dtype=torch.long, device=device)
         self.quantile = quantile
         self.factor = factor
-        self.i = 0
+        self.foreach = foreach
 
     def append(self, grad_norm):
-        self.buffer[self.i] = grad_norm
-        self.i = (self.i + 1) % len(self.buffer)
+        # non-finite norms are skipped by rewriting the current slot and not advancing
+        valid = torch.isfinite(grad_norm)
+        self.buffer[self.i] = torch.where(valid, grad_norm, self.buffer[self.i])
+        self.i = (self.i + valid.long()) % len(self.buffer)
 
     def __call__(self, parameters):
-        max_norm = self.factor * np.quantile(self.buffer, self.quantile)
-        grad_norm = torch.nn.utils.clip_grad_norm_(parameters, max_norm=max_norm).item()
-        if not math.isnan(grad_norm):
-            self.append(grad_norm)
+        max_norm = self.factor * torch.quantile(self.buffer, self.quantile)
+        grads = [p.grad for p in parameters if p.grad is not None]
+        if not grads:
+            return torch.zeros((), device=self.buffer.device)
+        grad_norm = torch.nn.utils.get_total_norm(grads, foreach=self.foreach)
+        # clip_grad_norm_ converts max_norm with float(), so scale by the device threshold here
+        clip_coef = torch.clamp(max_norm / (grad_norm + 1e-6), max=1.0)
+        if self.foreach:
+            torch._foreach_mul_(grads, clip_coef)
+        else:
+            for grad in grads:
+                grad.mul_(clip_coef)
+        self.append(grad_norm)
         return grad_norm
 
 
+class Prefetcher:
+    """
+    Copy batches from `loader` to `device` on a side stream, one batch ahead
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    def to_device(self, batch):
+        return tuple(x.to(self.device, non_blocking=True) for x in batch)
+
+    def preload(self, batches):
+        batch = next(batches, None)
+        if batch is None:
+            return None
+        with torch.cuda.stream(self.stream):
+            return self.to_device(batch)
+
+    def __iter__(self):
+        if self.stream is None:
+            yield from map(self.to_device, self.loader)
+            return
+
+        batches = iter(self.loader)
+        next_batch = self.preload(batches)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            # tensors allocated on the side stream are now used on the current stream
+            for x in batch:
+                x.record_stream(current_stream)
+            next_batch = self.preload(batches)
+            yield batch
+
+
 class Trainer:
     def __init__(
         self, model, device, train_loader, valid_loader, criterion=None,
         use_amp=True, lr_scheduler_fn=None, restore_optim=False,
         save_optim_every=10, grad_accum_split=1, quantile_grad_clip=False,
-        chunks_per_epoch=None, batch_size=None, pre_training=False
+        chunks_per_epoch=None, batch_size=None, pre_training=False,
+        channels_last=False, log_every=16, compile=False, use_checkpointing=False
     ):
+        # tf32 tensor core math for fp32 matmuls and convolutions (cudnn.benchmark is set by init)
+        torch.set_float32_matmul_precision('high')
+        torch.backends.cudnn.allow_tf32 = True
+
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.rank = dist.get_rank() if self.distributed else 0
+        self.world_size = dist.get_world_size() if self.distributed else 1
         self.model = model.to(device)
-        self.device = device
+        if use_checkpointing:
+            # trades compute for memory so larger batches fit without grad_accum_split
+            checkpoint_activations(self.model)
+        self.channels_last = channels_last
+        if channels_last:
+            for module in self.model.modules():
+                if isinstance(module, (torch.nn.Conv1d, torch.nn.Conv2d)):
+                    module.weight.data = to_channels_last(module.weight.data)
+        if self.distributed:
+            self.model = DistributedDataParallel(self.model, device_ids=[device])
+        self.compiled = compile
+        if compile:
+            # chunks are fixed size so compile for static shapes
+            self.model = torch.compile(self.model, dynamic=False, mode='reduce-overhead')
+        # trainable parameters for the per-step grad clip
+        self.params = [p for p in self.model.parameters() if p.requires_grad]
+        self.device = torch.device(device)
         self.train_loader = train_loader
         self.valid_loader = valid_loader
         self.criterion = criterion or model.loss
@@ -105,120 +221,203 @@ class Trainer:
         self.restore_optim = restore_optim
         self.save_optim_every = save_optim_every
         self.grad_accum_split = grad_accum_split
-        self.scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
+        # bf16 has the range of fp32 so only fp16 needs loss scaling, otherwise the scaler is a no-op.
+        # pre-ampere gpus only emulate bf16, so keep fp16 tensor cores there
+        bf16 = self.device.type == 'cuda' and torch.cuda.get_device_capability(self.device)[0] >= 8
+        self.amp_dtype = torch.bfloat16 if bf16 else torch.float16
+        self.scaler = torch.amp.GradScaler('cuda', enabled=use_amp and self.amp_dtype == torch.float16)
         self.optimizer = None
+        # the fused multi-tensor norm is only available for cuda tensors
+        foreach = True if self.device.type == 'cuda' else None
         if quantile_grad_clip:
-            self.clip_grad = ClipGrad()
+            self.clip_grad = ClipGrad(foreach=foreach, device=self.device)
         else:
-            self.clip_grad = lambda parameters: torch.nn.utils.clip_grad_norm_(parameters, max_norm=2.0).item()
+            self.clip_grad = lambda parameters: torch.nn.utils.clip_grad_norm_(parameters, max_norm=2.0, foreach=foreach)
 
         self.batch_size = batch_size
         self.chunks_per_epoch = chunks_per_epoch
-        self.steps_per_epoch = chunks_per_epoch // batch_size
+        # each process sees 1 / world_size of the chunks per epoch
+        self.steps_per_epoch = chunks_per_epoch // (batch_size * self.world_size)
         self.pre_training = pre_training
+        self.log_every = log_every
+        # each pending validation decode holds its full scores tensor, so keep the queue short
+        self.max_pending_decodes = 2
 
     def train_one_step(self, batch):
-        self.optimizer.zero_grad()
+        self.optimizer.zero_grad(set_to_none=True)
+
+        # move the whole batch once, chunking into micro-batches only creates views
+        data, *rest = (x.to(self.device, non_blocking=True) for x in batch)
+        if self.channels_last: data = to_channels_last(data)
+        batch = (data, *rest)
 
         losses = None
-        with amp.autocast(enabled=self.use_amp):
-            for batch_ in zip(
-                *map(lambda t: t.chunk(self.grad_accum_split, dim=0), batch)
-            ):
-                if self.pre_training:
-                    data_, hp_lengths, is_hp, hp_bases = (x.to(self.device) for x in batch_)
-                    hp_labels = {
-                        'hp_lengths': hp_lengths,
-                        'is_hp': is_hp,
-                        'hp_bases': hp_bases
-                    }
-
-                    targets_, lengths_ = None, None
-                    scores_ = self.model(data_, hp_true_labels=hp_labels)
+        batches = list(zip(*map(lambda t: t.chunk(self.grad_accum_split, dim=0), batch)))
+        with torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.use_amp):
+            for i, batch_ in enumerate(batches):
+                # only allreduce gradients on the final micro-batch
+                if self.distributed and i < len(batches) - 1:
+                    sync_context = self.model.no_sync()
                 else:
-                    data_, targets_, lengths_, *args = (x.to(self.device) for x in batch_)
-                    scores_ = self.model(data_, *args)
-                
-                losses_ = self.criterion(scores_, targets_, lengths_)
+                    sync_context = nullcontext()
+                with sync_context:
+                    if self.pre_training:
+                        data_, hp_lengths, is_hp, hp_bases = batch_
+                        hp_labels = {
+                            'hp_lengths': hp_lengths,
+                            'is_hp': is_hp,
+                            'hp_bases': hp_bases
+                        }
+
+                        targets_, lengths_ = None, None
+                        scores_ = self.model(data_, hp_true_labels=hp_labels)
+                    else:
+                        data_, targets_, lengths_, *args = batch_
+                        scores_ = self.model(data_, *args)
 
-                if not isinstance(losses_, dict): losses_ = {'loss': losses_}
+                    losses_ = self.criterion(scores_, targets_, lengths_)
 
-                total_loss = losses_.get('total_loss', losses_['loss']) / self.grad_accum_split
-                self.scaler.scale(total_loss).backward()
+                    if not isinstance(losses_, dict): losses_ = {'loss': losses_}
 
-                losses = {
-                    k: ((v.item() / self.grad_accum_split) if losses is None else (v.item() / self.grad_accum_split) + losses[k])
-                    for k, v in losses_.items()
-                }
+                    total_loss = losses_.get('total_loss', losses_['loss']) / self.grad_accum_split
+                    self.scaler.scale(total_loss).backward()
+
+                # accumulate on device to avoid a host sync per micro-batch
+                if losses is None:
+                    losses = {k: v.detach() for k, v in losses_.items()}
+                else:
+                    for k, v in losses_.items():
+                        losses[k] += v.detach()
+
+        losses = {k: v / self.grad_accum_split for k, v in losses.items()}
 
-        scale = self.scaler.get_scale()
+        # keep the scale on device, update() modifies it in place
+        scale = self.scaler._scale.clone() if self.scaler.is_enabled() else 1.0
         self.scaler.unscale_(self.optimizer)
-        grad_norm = self.clip_grad(self.model.parameters())
+        if self.found_inf():
+            # the scaler will skip this optimizer step so don't clip (or record) the gradients
+            self.scaler.update()
+            return losses, torch.tensor(float('nan'), device=self.device), scale
+
+        grad_norm = self.clip_grad(self.params)
         self.scaler.step(self.optimizer)
         self.scaler.update()
 
         return losses, grad_norm, scale
 
+    def found_inf(self):
+        """
+        Check if `scaler.unscale_` found inf/nan gradients for this step
+        """
+        if not self.scaler.is_enabled():
+            return False
+        # fused optimizers skip the step on device, so checking here would add a host sync.
+        # clipping overflowed grads is harmless as ClipGrad ignores non-finite norms
+        if getattr(self.optimizer, '_step_supports_amp_scaling', False):
+            return False
+        # scaler.step makes the same check before deciding to skip the optimizer step.
+        # _per_optimizer_states is private GradScaler state, layout checked against torch 2.6
+        found_inf_per_device = self.scaler._per_optimizer_states[id(self.optimizer)]["found_inf_per_device"]
+        # reduce on device so there is a single host sync
+        return sum(v.to(self.device) for v in found_inf_per_device.values()).item() > 0
+
     def train_one_epoch(self, loss_log, lr_scheduler):
         t0 = perf_counter()
         chunks = 0
         self.model.train()
 
+        tqdm_kwargs = tqdm_environ()
+        if self.rank != 0: tqdm_kwargs['disable'] = True
+
         # total is in batches and desc represents the number of training chunks supplied
         progress_bar = tqdm(
             total=self.steps_per_epoch, desc='[0/{}]'.format(self.chunks_per_epoch),
             ascii=True, leave=True, ncols=100, bar_format='{l_bar}{bar}| [{elapsed}{postfix}]',
-            **tqdm_environ()
+            **tqdm_kwargs
         )
         smoothed_losses = {}
 
+        # per-step stats stay on device and are flushed every `log_every` steps
+        pending = []
+
         with progress_bar:
 
-            for batch in islice(self.train_loader, self.steps_per_epoch):
-                chunks += batch[0].shape[0]
-                losses, grad_norm, scale = self.train_one_step(batch)
+            # flush in finally so an interrupted epoch still logs its last steps
+            try:
+                for batch in Prefetcher(islice(self.train_loader, self.steps_per_epoch), self.device):
+                    chunks += batch[0].shape[0] * self.world_size
+                    losses, grad_norm, scale = self.train_one_step(batch)
 
-                for k, v in losses.items():
-                    if k not in smoothed_losses:
-                        smoothed_losses[k] = v
-                    else:
-                        smoothed_losses[k] = 0.01 * v + 0.99 * smoothed_losses[k]
+                    lr = None
+                    if loss_log is not None:
+                        lr = lr_scheduler.get_last_lr()
+                        if len(lr) == 1: lr = lr[0]
+                    pending.append((chunks, perf_counter() - t0, lr, scale, grad_norm, losses))
 
-                if self.pre_training:
-                    postfix_dict = {
-                        k.rstrip("_loss"): f"{v:.4f}"
-                        for k, v in smoothed_losses.items()
-                        if k != "ctc_loss"
-                    } 
-                    progress_bar.set_postfix(**postfix_dict)
-                else:
-                    main_loss = smoothed_losses.get('loss', 0.0)
-                    progress_bar.set_postfix(loss='%.4f' % main_loss)
-
-                progress_bar.set_description("[{}/{}]".format(chunks, self.chunks_per_epoch))
-                progress_bar.update()
-
-                if loss_log is not None:
-                    lr = lr_scheduler.get_last_lr()
-                    if len(lr) == 1: lr = lr[0]
-                    loss_log.append({
-                        'chunks': chunks,
-                        'time': perf_counter() - t0,
-                        'grad_norm': grad_norm,
-                        'lr': lr,
-                        'scale': scale,
-                        **losses
-                    })
+                    if len(pending) == self.log_every:
+                        self.flush_log(pending, smoothed_losses, loss_log, progress_bar)
+                        pending = []
 
-                if lr_scheduler is not None: lr_scheduler.step()
+                    if lr_scheduler is not None: lr_scheduler.step()
+            finally:
+                if pending:
+                    self.flush_log(pending, smoothed_losses, loss_log, progress_bar)
 
         smoothed_loss = smoothed_losses.get('loss', 0.0)
         return smoothed_loss, perf_counter() - t0
 
-    def validate_one_step(self, batch):
-        with amp.autocast(enabled=self.use_amp):
+    def flush_log(self, pending, smoothed_losses, loss_log, progress_bar):
+        """
+        Copy the stats for a batch of training steps to the host in one transfer and log them
+        """
+        keys = list(pending[0][-1])
+        values = torch.stack([
+            torch.stack([
+                torch.as_tensor(scale, device=self.device).float(),
+                torch.as_tensor(grad_norm, device=self.device).float(),
+                *(losses[k].float() for k in keys)
+            ])
+            for *_, scale, grad_norm, losses in pending
+        ]).tolist()
+
+        for (chunks, time, lr, *_), (scale, grad_norm, *step_losses) in zip(pending, values):
+            losses = dict(zip(keys, step_losses))
+
+            for k, v in losses.items():
+                if k not in smoothed_losses:
+                    smoothed_losses[k] = v
+                else:
+                    smoothed_losses[k] = 0.01 * v + 0.99 * smoothed_losses[k]
+
+            if loss_log is not None:
+                loss_log.append({
+                    'chunks': chunks,
+                    'time': time,
+                    'grad_norm': grad_norm,
+                    'lr': lr,
+                    'scale': scale,
+                    **losses
+                })
+
+        if self.pre_training:
+            postfix_dict = {
+                k.rstrip("_loss"): f"{v:.4f}"
+                for k, v in smoothed_losses.items()
+                if k != "ctc_loss"
+            }
+            progress_bar.set_postfix(**postfix_dict)
+        else:
+            main_loss = smoothed_losses.get('loss', 0.0)
+            progress_bar.set_postfix(loss='%.4f' % main_loss)
+
+        progress_bar.set_description("[{}/{}]".format(pending[-1][0], self.chunks_per_epoch))
+        progress_bar.update(len(pending))
+
+    def validate_one_step(self, batch, decode_pool):
+        with torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.use_amp):
             if self.pre_training:
                 data, hp_lengths, is_hp, hp_bases = (x.to(self.device) for x in batch)
+                if self.channels_last: data = to_channels_last(data)
                 hp_labels = {
                     'hp_lengths': hp_lengths,
                     'is_hp': is_hp,
@@ -228,40 +427,84 @@ class Trainer:
                 losses = self.criterion(scores, None, None)
             else:
                 data, targets, lengths, *args = batch
-                scores = self.model(data.to(self.device), *(x.to(self.device) for x in args))
+                data = data.to(self.device)
+                if self.channels_last: data = to_channels_last(data)
+                scores = self.model(data, *(x.to(self.device) for x in args))
                 losses = self.criterion(scores, targets.to(self.device), lengths.to(self.device))
 
         losses = {k: v.item() for k, v in losses.items()} if isinstance(losses, dict) else losses.item()
         if self.pre_training:
-            return [], [], [], losses
+            return None, losses
 
         if isinstance(scores, dict):
                 scores = scores['logits']
-        if hasattr(self.model, 'decode_batch'):
-            seqs = self.model.decode_batch(scores)
-        else:
-            seqs = [self.model.decode(x) for x in permute(scores, 'TNC', 'NTC')]
-        refs = [decode_ref(target, self.model.alphabet) for target in targets]
+        if not hasattr(unwrap(self.model), 'decode_batch'):
+            # cpu decoders don't need the scores kept on the device
+            scores = scores.cpu()
+        elif self.compiled:
+            # cuda graph outputs are overwritten by the next forward, which runs before the decode
+            scores = scores.clone()
+        # decode in the background so it overlaps with the next batch's forward
+        return decode_pool.submit(self.decode_one_step, scores, targets), losses
+
+    def decode_one_step(self, scores, targets):
+        model = unwrap(self.model)
+        # grad mode is thread local so restate no_grad for the worker thread
+        with torch.no_grad():
+            if hasattr(model, 'decode_batch'):
+                seqs = model.decode_batch(scores)
+            else:
+                seqs = [model.decode(x) for x in permute(scores, 'TNC', 'NTC')]
+        refs = decode_refs(targets, model.alphabet)
 
-        n_pre = getattr(self.model, "n_pre_context_bases", 0)
-        n_post = getattr(self.model, "n_post_context_bases", 0)
+        n_pre = getattr(model, "n_pre_context_bases", 0)
+        n_post = getattr(model, "n_post_context_bases", 0)
         if n_pre > 0 or n_post > 0:
             refs = [ref[n_pre:len(ref)-n_post] for ref in refs]
 
         accs = [
             accuracy(ref, seq, min_coverage=0.5) if len(seq) else 0. for ref, seq in zip(refs, seqs)
         ]
-        return seqs, refs, accs, losses
+        return seqs, refs, accs
 
     def validate_one_epoch(self):
         self.model.eval()
-        with torch.no_grad():
-            seqs, refs, accs, losses = zip(*(self.validate_one_step(batch) for batch in self.valid_loader))
-        loss = np.mean([(x['loss'] if isinstance(x, dict) else x) for x in losses])
+        accs, loss_sum, n = [], 0.0, 0
+        decoding = deque()
+
+        # decoding runs on a worker thread, which needs the right current cuda device
+        if self.device.type == 'cuda':
+            device_index = self.device.index if self.device.index is not None else torch.cuda.current_device()
+            pool_kwargs = {'initializer': torch.cuda.set_device, 'initargs': (device_index,)}
+        else:
+            pool_kwargs = {}
+
+        with torch.no_grad(), ThreadPoolExecutor(max_workers=1, **pool_kwargs) as decode_pool:
+            for batch in self.valid_loader:
+                decoded, losses = self.validate_one_step(batch, decode_pool)
+                if decoded is not None:
+                    decoding.append(decoded)
+                # bound the number of batches held in flight
+                while len(decoding) > self.max_pending_decodes:
+                    accs.extend(decoding.popleft().result()[2])
+                loss_sum += losses['loss'] if isinstance(losses, dict) else losses
+                n += 1
+            while decoding:
+                accs.extend(decoding.popleft().result()[2])
+        if self.distributed:
+            # each process validated its own shard, combine them
+            totals = torch.tensor([loss_sum, n], dtype=torch.float64, device=self.device)
+            dist.all_reduce(totals)
+            loss_sum, n = totals.tolist()
+            shard_accs = [None] * self.world_size
+            dist.all_gather_object(shard_accs, accs)
+            accs = [acc for shard in shard_accs for acc in shard]
+        loss = loss_sum / n
         if self.pre_training:
             return loss, 0.0, 0.0
-        seqs, refs, accs = (sum(x, []) for x in (seqs, refs, accs))
-        return loss, np.mean(accs), np.median(accs)
+        # accuracies come from host-side alignment so aggregate them in one array
+        accs = np.fromiter(accs, dtype=np.float64, count=len(accs))
+        return loss, accs.mean(), np.median(accs)
 
     def init_optimizer(self, lr, **optim_kwargs):
         if "package" in optim_kwargs:
@@ -269,6 +512,10 @@ class Trainer:
         else:
             optim_cls = torch.optim.AdamW
 
+        # fused and foreach are mutually exclusive, so respect a configured foreach
+        if optim_cls is torch.optim.AdamW and self.device.type == 'cuda' and 'foreach' not in optim_kwargs:
+            optim_kwargs.setdefault('fused', True)
+
         print(f"[loading optim] - '{optim_cls.__name__}' with args: {optim_kwargs}")
         optim_kwargs["lr"] = lr
         self.optimizer = optim_cls(self.model.parameters(), **optim_kwargs)
@@ -281,29 +528,47 @@ class Trainer:
         if self.optimizer is None:
             self.init_optimizer(lr, **optim_kwargs)
 
+        # load_state_dict replaces the param groups, including the kernel flags the optimizer was built with
+        kernel_flags = [
+            {k: pg[k] for k in ("fused", "foreach") if k in pg} for pg in self.optimizer.param_groups
+        ]
+
         last_epoch = load_state(workdir, self.device, self.model, self.optimizer if self.restore_optim else None)
 
         if self.restore_optim:
         # override learning rate to new value
             for i, pg in enumerate(self.optimizer.param_groups):
                 pg["initial_lr"] = pg["lr"] = lr[i] if isinstance(lr, (list, tuple)) else lr
+                pg.update(kernel_flags[i])
 
         lr_scheduler = self.get_lr_scheduler(epochs, last_epoch=last_epoch)
 
+        is_main = self.rank == 0
+
         for epoch in range(1 + last_epoch, epochs + 1):
+            if isinstance(getattr(self.train_loader, 'sampler', None), DistributedSampler):
+                self.train_loader.sampler.set_epoch(epoch)
             try:
-                with bonito.io.CSVLogger(os.path.join(workdir, 'losses_{}.csv'.format(epoch))) as loss_log:
+                if is_main:
+                    log_context = bonito.io.CSVLogger(os.path.join(workdir, 'losses_{}.csv'.format(epoch)))
+                else:
+                    log_context = nullcontext()
+                with log_context as loss_log:
                     train_loss, duration = self.train_one_epoch(loss_log, lr_scheduler)
 
-                model_state = self.model.module.state_dict() if hasattr(self.model, 'module') else self.model.state_dict()
-                torch.save(model_state, os.path.join(workdir, "weights_%s.tar" % epoch))
-                if epoch % self.save_optim_every == 0:
-                    torch.save(self.optimizer.state_dict(), os.path.join(workdir, "optim_%s.tar" % epoch))
+                if is_main:
+                    model_state = unwrap(self.model).state_dict()
+                    torch.save(model_state, os.path.join(workdir, "weights_%s.tar" % epoch))
+                    if epoch % self.save_optim_every == 0:
+                        torch.save(self.optimizer.state_dict(), os.path.join(workdir, "optim_%s.tar" % epoch))
 
                 val_loss, val_mean, val_median = self.validate_one_epoch()
             except KeyboardInterrupt:
                 break
 
+            if not is_main:
+                continue
+
             print("[epoch {}] directory={} loss={:.4f} mean_acc={:.3f}% median_acc={:.3f}%".format(
                 epoch, workdir, val_loss, val_mean, val_median
             ))
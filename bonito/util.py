@@ -128,6 +128,16 @@ def decode_ref(encoded, labels):
     return ''.join(labels[e] for e in encoded.tolist() if e)
 
 
+def decode_refs(encoded, labels):
+    """
+    Convert a batch of zero padded integer encoded references into strings
+    """
+    if not all(len(label.encode()) == 1 for label in labels):
+        return [decode_ref(e, labels) for e in encoded]
+    lookup = np.frombuffer(''.join(labels).encode(), dtype='u1')
+    return [lookup[e[e != 0]].tobytes().decode() for e in torch.as_tensor(encoded).cpu().numpy()]
+
+
 def column_to_set(filename, idx=0, skip_header=False):
     """
     Pull a column from a file and return a set of the values.
@@ -296,13 +306,10 @@ def _load_model(model_file, config, device, half=True, use_koi=False):
         )
 
     state_dict = torch.load(model_file, map_location=device)
-    state_dict = {k2: state_dict[k1] for k1, k2 in match_names(state_dict, model).items()}
-    new_state_dict = OrderedDict()
-    for k, v in state_dict.items():
-        name = k.replace('module.', '')
-        new_state_dict[name] = v
-
-    model.load_state_dict(new_state_dict)
+    state_dict = {
+        k2.removeprefix('module.'): state_dict[k1] for k1, k2 in match_names(state_dict, model).items()
+    }
+    model.load_state_dict(state_dict)
 
     if half:
         model = model.half()